@@ -1,5 +1,14 @@
-bind = "0.0.0.0:5000"
+import multiprocessing, os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+# 任务状态（TASKS）保存在进程内存里，多个 worker 之间不共享：
+# 上传和 /progress 可能落到不同 worker，所以 worker 固定 1 个，并发靠线程
+# （不读 WEB_CONCURRENCY：Heroku 等平台会按内存自动设置它）
 workers = 1
+worker_class = "gthread"
+# 每个 SSE 连接长期占用一个线程，按 CPU 数放大线程池
+threads = max(8, multiprocessing.cpu_count() * 4)
+worker_connections = 1000
 timeout = 300
 keepalive = 2
 preload_app = True
@@ -1,125 +1,506 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, render_template, request, jsonify, send_file, Response
-import requests, time, os, tempfile, shutil, threading, uuid, json
-from openpyxl import load_workbook
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response
+import requests, time, os, tempfile, shutil, threading, uuid, json, selectors, socket, datetime
+from collections import OrderedDict
+from dataclasses import dataclass, field, fields
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote_plus
+from zipfile import ZipFile, ZIP_DEFLATED
+from openpyxl import Workbook, load_workbook
+from openpyxl.writer.excel import ExcelWriter
+from werkzeug.exceptions import NotFound
 from werkzeug.utils import secure_filename
 
+# SSE 序列化：优先用 orjson（C 扩展，默认输出 UTF-8），未安装时回退标准库
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
+# 前面有 nginx 等反代时设置 USE_X_SENDFILE=1，由反代直接发送文件
+app.config['USE_X_SENDFILE'] = os.environ.get("USE_X_SENDFILE") == "1"
+
+OUTPUT_DIR = "/tmp"
 
 TASKS = {}
-TASKS_LOCK = threading.Lock()
+TASKS_LOCK = threading.Lock()  # 仅串行化 TASKS 的增删（写时复制）
 TASK_RETENTION_SECONDS = 1800
+JANITOR_INTERVAL_SECONDS = 60
+PROGRESS_INTERVAL_SECONDS = 0.5
+_MSG_TMPL = "翻译中({}/{})"
+UPLOAD_COPY_BUFSIZE = 64 * 1024
+XLSX_MAGIC = b"PK\x03\x04"  # .xlsx 是 zip 包
+SSE_HEARTBEAT_SECONDS = 30
+SSE_DISCONNECT_CHECK_SECONDS = 5
+XLSX_COMPRESSLEVEL = 1  # 下载即用，换取更快的保存
+STREAMING_MIN_BYTES = 8 * 1024 * 1024  # 超过此大小的上传走流式精简写出（不保留格式）
+TRANSLATE_WORKERS = 8
+TRANSLATE_CHUNK = 30
+TRANSLATE_MAX_QUERY_LEN = 6000  # 批量请求 q 参数编码后的总长度上限
+TRANSLATE_URL = "https://translate.googleapis.com/translate_a/single"
+TRANSLATE_FAILED = "翻译失败"
+CACHE_SIZE = 100_000
+
+# ====== 全局自适应令牌桶限速（所有线程共享）======
+# 成功时逐步恢复到 base_rate；遇到 429/503 时降速并保持一段时间
+class TokenBucket:
+    def __init__(self, rate: float = 3.0, burst: int = 6, min_rate: float = 0.2):
+        self.base_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.penalty_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, factor: float = 2.0, duration: float = 60.0):
+        # 同一降速窗口内只降一次：并发的多个 429 不会把速率连续减半到下限
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = min(self.tokens, 0.0)
+            if now < self.penalty_until:
+                return
+            self.rate = max(self.min_rate, self.rate / factor)
+            self.penalty_until = now + duration
+
+    def reward(self, step: float = 1.1):
+        with self.lock:
+            now = time.monotonic()
+            if self.rate >= self.base_rate or now < self.penalty_until:
+                return
+            self._refill(now)
+            self.rate = min(self.base_rate, self.rate * step)
+
+BUCKET = TokenBucket()
+
+# ====== 共享 HTTP 会话：keep-alive + 连接池，所有工作线程复用 ======
+# 429/503 不在这里重试，交给 BUCKET 降速
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1, pool_maxsize=TRANSLATE_WORKERS, pool_block=True,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[500, 502, 504])
+))
+
+# ====== 译文 LRU 缓存（跨任务共享，只缓存成功结果）======
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+def _cache_get(text: str):
+    with _CACHE_LOCK:
+        value = _CACHE.get(text)
+        if value is not None:
+            _CACHE.move_to_end(text)
+        return value
+
+def _cache_put(text: str, value: str):
+    if not value or value == TRANSLATE_FAILED:
+        return
+    with _CACHE_LOCK:
+        _CACHE[text] = value
+        _CACHE.move_to_end(text)
+        if len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+
+def _dedup_key(text: str) -> str:
+    # 空白/大小写差异视为同一标题
+    return " ".join(text.split()).casefold()
+
+def _needs_translation(text: str) -> bool:
+    # 过短、纯数字、链接，以及只含数字/符号/汉字的内容不必请求翻译，原样写回
+    t = text.strip()
+    if len(t) < 2 or t.isdigit() or t.lower().startswith(("http://", "https://", "www.")):
+        return False
+    return any(c.isalpha() and not ("\u4e00" <= c <= "\u9fff") for c in t)
 
 # ====== 限速+重试翻译 ======
 def translate_text(text: str) -> str:
     if not text or not text.strip():
         return ""
     text = text[:5000]
-    url = "https://translate.googleapis.com/translate_a/single"
+    cached = _cache_get(text)
+    if cached is not None:
+        return cached
+    result = _translate_uncached(text)
+    _cache_put(text, result)
+    return result
+
+def _translate_uncached(text: str) -> str:
     params = dict(client="gtx", sl="auto", tl="zh", dt="t", q=text)
     for attempt in range(1, 4):
         try:
-            r = requests.get(url, params=params, timeout=15)
+            BUCKET.acquire()
+            r = SESSION.get(TRANSLATE_URL, params=params, timeout=15)
+            if r.status_code in (429, 503):
+                BUCKET.penalize(2.0)
             if r.status_code == 200:
+                BUCKET.reward()
                 data = r.json()
-                return "".join(seg[0] for seg in data[0]) if data and data[0] else "翻译失败"
+                return "".join(seg[0] for seg in data[0]) if data and data[0] else TRANSLATE_FAILED
             time.sleep((2 ** attempt) + 0.5)
         except Exception as e:
             if attempt == 3:
                 print("[ERROR] translate_text 最终失败:", e)
-                return "翻译失败"
+                return TRANSLATE_FAILED
             time.sleep((2 ** attempt) + 0.5)
-    return "翻译失败"
+    return TRANSLATE_FAILED
+
+# ====== 批量翻译：一次请求带多个 q，失败回退逐条 ======
+def _parse_batch(data, n: int):
+    # 期望每个 q 对应一个顶层元素，元素是分段列表：[[[译文, 原文, ...], ...], ...]
+    # 结构不符（含单 q 响应碰巧长度相同）一律返回 None
+    if not isinstance(data, list) or len(data) != n:
+        return None
+    out = []
+    for item in data:
+        if not isinstance(item, list) or not item:
+            return None
+        if not all(isinstance(seg, list) and seg and isinstance(seg[0], str) for seg in item):
+            return None
+        out.append("".join(seg[0] for seg in item))
+    return out
+
+def _request_batch(texts: list, should_stop=None):
+    # 返回译文列表；响应结构不可信时返回 None（调用方逐条回退）
+    # 429/503/网络错误：降速后经 BUCKET 重试整批，仍失败则整批记为失败，不拆成逐条请求
+    params = [("client", "gtx"), ("sl", "auto"), ("tl", "zh"), ("dt", "t"), *[("q", t) for t in texts]]
+    for attempt in range(1, 4):
+        if should_stop and should_stop():
+            return [TRANSLATE_FAILED] * len(texts)
+        try:
+            BUCKET.acquire()
+            r = SESSION.get(TRANSLATE_URL, params=params, timeout=30)
+        except Exception as e:
+            print("[WARN] translate_batch 请求失败:", e)
+            continue
+        if r.status_code in (429, 503):
+            BUCKET.penalize(2.0)
+            continue
+        if r.status_code != 200:
+            return None
+        BUCKET.reward()
+        try:
+            return _parse_batch(r.json(), len(texts))
+        except ValueError:
+            return None
+    print("[ERROR] translate_batch 最终失败，本批记为翻译失败")
+    return [TRANSLATE_FAILED] * len(texts)
+
+def _split_by_query_len(texts: list) -> list:
+    # 按 URL 编码后的长度分组，避免 GET 过长（414）
+    groups, cur, cur_len = [], [], 0
+    for t in texts:
+        n = len(quote_plus(t)) + 3  # "&q="
+        if cur and cur_len + n > TRANSLATE_MAX_QUERY_LEN:
+            groups.append(cur)
+            cur, cur_len = [], 0
+        cur.append(t)
+        cur_len += n
+    if cur:
+        groups.append(cur)
+    return groups
+
+def translate_batch(texts: list, should_stop=None) -> list:
+    # should_stop：任务取消回调，在分组/逐条之间检查，取消后剩余的直接记为失败
+    texts = [t[:5000] for t in texts]
+    results = [_cache_get(t) for t in texts]
+    fetched = {}
+    for group in _split_by_query_len([t for t, res in zip(texts, results) if res is None]):
+        if should_stop and should_stop():
+            break
+        parsed = _request_batch(group, should_stop) if len(group) > 1 else None
+        if parsed is None:
+            # 单条或批量结果不可信：逐条翻译（translate_text 自行缓存成功结果）
+            for t in group:
+                if should_stop and should_stop():
+                    break
+                fetched[t] = translate_text(t)
+            continue
+        for t, res in zip(group, parsed):
+            _cache_put(t, res)
+            fetched[t] = res
+    return [res if res is not None else fetched.get(t, TRANSLATE_FAILED) for t, res in zip(texts, results)]
 
 # ====== 任务/状态工具 ======
+# 每个任务一把锁（条件变量共用），TASKS 本身写时复制：读者无需加锁
+@dataclass
+class TaskState:
+    status: str = "idle"
+    percent: int = 0
+    total: int = 0
+    current: int = 0
+    cancel_requested: bool = False
+    tmp_dir: Optional[str] = None
+    filename: Optional[str] = None
+    message: Optional[str] = None
+    eta_seconds: Optional[int] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    duration_seconds: Optional[float] = None
+    download_filename: Optional[str] = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    cond: threading.Condition = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.cond = threading.Condition(self.lock)
+
+    def _as_dict(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.compare}
+
+    def update(self, kv: dict):
+        with self.cond:
+            for k, v in kv.items():
+                setattr(self, k, v)
+            self.cond.notify_all()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return self._as_dict()
+
 def _safe_update(task_id: str, kv: dict):
+    st = TASKS.get(task_id)
+    if st:
+        st.update(kv)
+
+def _get_state(task_id: str):
+    st = TASKS.get(task_id)
+    return st.snapshot() if st else {}
+
+def _cancel_requested(task_id: str) -> bool:
+    st = TASKS.get(task_id)
+    return bool(st and st.cancel_requested)
+
+def _add_task(task_id: str, st: TaskState):
+    global TASKS
+    with TASKS_LOCK:
+        TASKS = {**TASKS, task_id: st}
+
+def _remove_task(task_id: str):
+    global TASKS
     with TASKS_LOCK:
         st = TASKS.get(task_id)
-        if st:
-            st.update(kv)
+        TASKS = {k: v for k, v in TASKS.items() if k != task_id}
+    if st:
+        with st.cond:
+            st.cond.notify_all()
 
-def _get_state(task_id: str):
+def _wait_for_change(task_id: str, snapshot: dict, timeout: float) -> bool:
+    # 阻塞直到任务状态与 snapshot 不同（或任务被清理），超时返回 False
+    st = TASKS.get(task_id)
+    if not st:
+        return True
+    with st.cond:
+        return st.cond.wait_for(lambda: TASKS.get(task_id) is not st or st._as_dict() != snapshot,
+                                timeout=timeout)
+
+# ====== 单一清理线程：定期移除过期任务 ======
+_JANITOR_STARTED = False
+
+def _janitor_loop():
+    while True:
+        time.sleep(JANITOR_INTERVAL_SECONDS)
+        now = time.time()
+        for task_id, st in list(TASKS.items()):
+            if st.finished_at and now - st.finished_at > TASK_RETENTION_SECONDS:
+                _remove_task(task_id)
+
+def _ensure_janitor():
+    # 延迟到首个任务时启动：gunicorn preload_app 下 fork 前启动的线程不会带到 worker
+    global _JANITOR_STARTED
     with TASKS_LOCK:
-        return dict(TASKS.get(task_id) or {})
+        if _JANITOR_STARTED:
+            return
+        _JANITOR_STARTED = True
+    threading.Thread(target=_janitor_loop, daemon=True).start()
+
+# ====== 保存：同 Workbook.save，但可指定 zip 压缩级别 ======
+def _save_workbook(wb: Workbook, path: str):
+    if wb.write_only and not wb.worksheets:
+        wb.create_sheet()
+    wb.properties.modified = datetime.datetime.utcnow()
+    with ZipFile(path, "w", ZIP_DEFLATED, allowZip64=True, compresslevel=XLSX_COMPRESSLEVEL) as archive:
+        ExcelWriter(wb, archive).save()
 
-def _schedule_state_cleanup(task_id: str):
-    def _cleanup():
-        time.sleep(TASK_RETENTION_SECONDS)
-        with TASKS_LOCK:
-            TASKS.pop(task_id, None)
-    threading.Thread(target=_cleanup, daemon=True).start()
+# ====== 写出：完整模式（保留格式/其它工作表）======
+def _write_full(file_path: str, output_path: str, insert_idx: int, replace_existing: bool,
+                rows: list, value_for):
+    wb = load_workbook(file_path)
+    ws = wb.active
+    if not replace_existing:
+        ws.insert_cols(insert_idx)
+    ws.cell(row=1, column=insert_idx, value="中文")
+    for r in rows:
+        ws.cell(row=r, column=insert_idx, value=value_for(r))
+    _save_workbook(wb, output_path)
 
-# ====== 核心：分页+断点续翻 ======
+# ====== 写出：流式模式（超大文件）======
+# 只复制单元格值（含公式），以下内容不会保留：数字格式、字体/填充/边框/对齐、列宽行高、
+# 合并单元格、冻结窗格、筛选、数据验证、条件格式、批注、超链接、图片图表、图表工作表、
+# 定义名称、工作表保护。完成提示里会告知用户
+def _write_streaming(file_path: str, output_path: str, title_col_idx: int, insert_idx: int,
+                     replace_existing: bool, value_for):
+    src = load_workbook(file_path, read_only=True)
+    try:
+        active_ws = src.active
+        out = Workbook(write_only=True)
+        for src_ws in src.worksheets:
+            src_ws.reset_dimensions()
+            out_ws = out.create_sheet(title=src_ws.title)
+            if src_ws is not active_ws:
+                for row in src_ws.iter_rows(values_only=True):
+                    out_ws.append(row)
+                continue
+            # 只在活动表的 Title 后面插入译文
+            for r, row in enumerate(src_ws.iter_rows(values_only=True), start=1):
+                row = list(row)
+                if len(row) < title_col_idx:
+                    row.extend([None] * (title_col_idx - len(row)))
+                value = "中文" if r == 1 else value_for(r)
+                if replace_existing and len(row) >= insert_idx:
+                    row[insert_idx - 1] = value
+                else:
+                    row.insert(insert_idx - 1, value)
+                out_ws.append(row)
+        out.active = src.worksheets.index(active_ws)
+        _save_workbook(out, output_path)
+    finally:
+        src.close()
+
+# ====== 核心：流式读取+并发翻译+写出 ======
 def _run_task(file_path: str, task_id: str):
     _safe_update(task_id, {"status": "running", "message": "读取文件...", "percent": 0, "started_at": time.time()})
     try:
-        wb = load_workbook(file_path)
-        ws = wb.active
-        if not ws:
-            raise ValueError("空工作表")
-
-        # 1. 找 Title 列
-        title_col_idx = None
-        for idx, cell in enumerate(ws[1], 1):
-            if str(cell.value).strip().lower() == "title":
-                title_col_idx = idx
-                break
-        if not title_col_idx:
-            raise ValueError("找不到 Title 列")
-
-        # 2. 插入中文列
-        insert_idx = title_col_idx + 1
-        if ws.cell(row=1, column=insert_idx).value != "中文":
-            ws.insert_cols(insert_idx)
-            ws.cell(row=1, column=insert_idx, value="中文")
-
-        # 3. 待翻译行
-        rows_to_tr = [r for r in range(2, ws.max_row + 1)
-                      if str(ws.cell(row=r, column=title_col_idx).value).strip()]
-        total = len(rows_to_tr)
+        # 1. 只读模式扫描：找 Title 列、收集待翻译行（不构建完整单元格对象）
+        wb = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            if not ws:
+                raise ValueError("空工作表")
+            # 只读模式按 <dimension ref> 截断行列；第三方导出的值常常不准，先重置
+            ws.reset_dimensions()
+            header = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), None) or ()
+
+            norm = tuple(v.strip().lower() if isinstance(v, str) else "" for v in header)
+            try:
+                title_col_idx = norm.index("title") + 1
+            except ValueError:
+                raise ValueError("找不到 Title 列") from None
+
+            # 2. 中文列位置：已存在则覆盖，否则在 Title 后插入
+            insert_idx = title_col_idx + 1
+            replace_existing = len(header) >= insert_idx and header[insert_idx - 1] == "中文"
+
+            # 3. 待翻译行：只遍历 Title 这一列，得到 (行号, 标题)
+            titles = [(r, str(v)) for r, (v,) in enumerate(
+                          ws.iter_rows(min_row=2, min_col=title_col_idx, max_col=title_col_idx, values_only=True),
+                          start=2)
+                      if v is not None and str(v).strip()]
+        finally:
+            wb.close()
+
+        # 重复标题只翻译一次（按空白/大小写归一后的键去重）；无需翻译的原样写回
+        unique = {}
+        row_keys = {}
+        passthrough = {}
+        translated_map = {}
+        for r, v in titles:
+            if _needs_translation(v):
+                key = _dedup_key(v)
+                unique.setdefault(key, v)
+                row_keys[r] = key
+            else:
+                passthrough[r] = v
+        keys = list(unique)
+        total = len(keys)
         _safe_update(task_id, {"total": total, "current": 0})
-        if total == 0:
-            _safe_update(task_id, {"status": "done", "percent": 100, "message": "无需翻译"})
+        if not titles:
+            _safe_update(task_id, {"status": "done", "percent": 100, "message": "无需翻译", "finished_at": time.time()})
             return
 
-        # 4. 分页参数
-        BATCH = 20
+        # 4. 并发翻译：每 TRANSLATE_CHUNK 行发一次请求
         start = time.time()
         # ✅ 改到持久目录 /tmp
-        output_path = os.path.join("/tmp", os.path.splitext(os.path.basename(file_path))[0] + "_中文翻译.xlsx")
+        output_path = os.path.join(OUTPUT_DIR, os.path.splitext(os.path.basename(file_path))[0] + "_中文翻译.xlsx")
 
-        for batch_start in range(0, total, BATCH):
-            if _get_state(task_id).get("cancel_requested"):
-                _safe_update(task_id, {"status": "canceled", "message": "已取消"})
-                return
+        done_total = 0
+        last_percent, last_report = -1, 0.0
+        # 不用 with：退出时 with 会等待正在运行的批次；取消/异常时直接丢弃
+        def should_stop() -> bool:
+            return _cancel_requested(task_id)
 
-            batch_rows = rows_to_tr[batch_start:batch_start + BATCH]
-            for done_in_batch, row in enumerate(batch_rows, 1):
-                title_cell = ws.cell(row=row, column=title_col_idx)
-                translated = translate_text(str(title_cell.value))
-                ws.cell(row=row, column=insert_idx, value=translated)
+        pool = ThreadPoolExecutor(max_workers=TRANSLATE_WORKERS)
+        try:
+            futures = {}
+            for i in range(0, total, TRANSLATE_CHUNK):
+                chunk = keys[i:i + TRANSLATE_CHUNK]
+                futures[pool.submit(translate_batch, [unique[k] for k in chunk], should_stop)] = chunk
+            for fut in as_completed(futures):
+                if _cancel_requested(task_id):
+                    _safe_update(task_id, {"status": "canceled", "message": "已取消", "finished_at": time.time()})
+                    return
+                chunk = futures[fut]
+                translated_map.update(zip(chunk, fut.result()))
 
-                done_total = batch_start + done_in_batch
-                elapsed = max(time.time() - start, 1e-6)
-                eta = int((total - done_total) / (done_total / elapsed)) if done_total else 0
+                done_total += len(chunk)
+                # 进度节流：百分比变化或距上次上报超过 PROGRESS_INTERVAL_SECONDS 才更新
+                now = time.time()
                 percent = int(done_total * 100 / total)
+                if percent == last_percent and now - last_report < PROGRESS_INTERVAL_SECONDS:
+                    continue
+                last_percent, last_report = percent, now
+                elapsed = max(now - start, 1e-6)
+                eta = int((total - done_total) / (done_total / elapsed)) if done_total else 0
                 _safe_update(task_id, {
                     "current": done_total,
                     "percent": percent,
                     "eta_seconds": eta,
-                    "message": f"翻译中({done_total}/{total})"
+                    "message": _MSG_TMPL.format(done_total, total)
                 })
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        # 5. 写出：普通文件完整加载保留格式；超大文件走流式精简模式
+        def value_for(r: int):
+            # 重复标题直接复用同一个译文对象，不再为每行建副本
+            return passthrough[r] if r in passthrough else translated_map.get(row_keys.get(r))
 
-            # 每批后保存+限速
-            wb.save(output_path)
-            time.sleep(1.5)
+        _safe_update(task_id, {"message": "保存文件..."})
+        streaming = os.path.getsize(file_path) >= STREAMING_MIN_BYTES
+        if streaming:
+            _write_streaming(file_path, output_path, title_col_idx, insert_idx, replace_existing, value_for)
+        else:
+            _write_full(file_path, output_path, insert_idx, replace_existing, [r for r, _ in titles], value_for)
 
         _safe_update(task_id, {
             "status": "done",
             "percent": 100,
             "eta_seconds": 0,
-            "message": f"翻译完成，共处理 {total} 行",
+            "message": f"翻译完成，共处理 {len(titles)} 行" + ("（大文件精简模式：仅保留单元格值，格式未保留）" if streaming else ""),
             "download_filename": os.path.basename(output_path),
             "finished_at": time.time()
         })
@@ -132,29 +513,43 @@ def _run_task(file_path: str, task_id: str):
                 shutil.rmtree(base, ignore_errors=True)
         except Exception:
             pass
-        _schedule_state_cleanup(task_id)
 
 # ====== 其余路由/启动代码 ======
 def start_background_task(file_path: str, filename: str) -> str:
     task_id = uuid.uuid4().hex[:12]
-    with TASKS_LOCK:
-        TASKS[task_id] = {
-            "status": "idle", "percent": 0, "total": 0, "current": 0,
-            "cancel_requested": False, "tmp_dir": os.path.dirname(file_path),
-            "filename": filename
-        }
+    _add_task(task_id, TaskState(tmp_dir=os.path.dirname(file_path), filename=filename))
+    _ensure_janitor()
     threading.Thread(target=_run_task, args=(file_path, task_id), daemon=True).start()
     return task_id
 
+def _client_disconnected(sock) -> bool:
+    # 对端关闭后 socket 变为可读且 peek 读到 EOF；只有确认 EOF/被重置才算断开
+    # 用 selectors（Linux 上是 epoll）而不是 select.select：后者 fd ≥ 1024 会报错
+    if sock is None:
+        return False
+    try:
+        with selectors.DefaultSelector() as sel:
+            sel.register(sock, selectors.EVENT_READ)
+            if not sel.select(timeout=0):
+                return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (ConnectionResetError, BrokenPipeError):
+        return True
+    except (OSError, ValueError):
+        # 例如 SSLSocket 不支持 MSG_PEEK、暂不可读等：没有断开的证据
+        return False
+
 def sse_progress(task_id: str):
+    # 生成器里没有请求上下文，先取出底层 socket
+    sock = request.environ.get("gunicorn.socket") or request.environ.get("werkzeug.socket")
+
     def gen():
+        last_payload = None
         while True:
             st = _get_state(task_id)
             if not st:
-                yield f"data: {json.dumps({'status':'error','message':'任务不存在'})}\n\n"
+                yield f"data: {_dumps({'status': 'error', 'message': '任务不存在'})}\n\n"
                 break
-            # ===== Debug 日志 =====
-            print(f"[DEBUG] SSE send: download_url = {st.get('download_filename')}")
             payload = {
                 "task_id": task_id,
                 "status": st.get("status"),
@@ -167,10 +562,22 @@ def sse_progress(task_id: str):
                 "finished_at": st.get("finished_at"),
                 "duration_seconds": st.get("duration_seconds")
             }
-            yield f"event: progress\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+            if payload != last_payload:
+                # ===== Debug 日志 =====
+                print(f"[DEBUG] SSE send: download_url = {st.get('download_filename')}")
+                yield f"event: progress\ndata: {_dumps(payload)}\n\n"
+                last_payload = payload
             if st.get("status") in ("done", "error", "canceled"):
                 break
-            time.sleep(0.2)
+            # 有状态变化才唤醒；空闲时定期检查客户端是否已断开，并发心跳注释保持连接
+            idle = 0
+            while not _wait_for_change(task_id, st, timeout=SSE_DISCONNECT_CHECK_SECONDS):
+                if _client_disconnected(sock):
+                    return
+                idle += SSE_DISCONNECT_CHECK_SECONDS
+                if idle >= SSE_HEARTBEAT_SECONDS:
+                    yield ": keep-alive\n\n"
+                    idle = 0
     return Response(gen(), mimetype="text/event-stream")
 
 @app.route('/')
@@ -184,11 +591,17 @@ def upload_file():
         return jsonify({'error': '没有选择文件'}), 400
     if not file.filename.endswith('.xlsx'):
         return jsonify({'error': '请上传Excel文件(.xlsx)'}), 400
+    # 先看文件头，不是 zip 的直接拒绝，不落盘
+    head = file.stream.read(len(XLSX_MAGIC))
+    if head != XLSX_MAGIC:
+        return jsonify({'error': '请上传Excel文件(.xlsx)'}), 400
     try:
         filename = secure_filename(file.filename)
         temp_dir = tempfile.mkdtemp()
         file_path = os.path.join(temp_dir, filename)
-        file.save(file_path)
+        with open(file_path, 'wb') as f:
+            f.write(head)
+            shutil.copyfileobj(file.stream, f, length=UPLOAD_COPY_BUFSIZE)
         task_id = start_background_task(file_path, filename)
         return jsonify({'success': True, 'task_id': task_id}), 202
     except Exception as e:
@@ -205,8 +618,8 @@ def task_status(task_id):
 
 @app.route('/download/<filename>')
 def download_file(filename):
-    # 文件已保存在 /tmp，直接发送
-    file_path = os.path.join("/tmp", filename)
-    if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True, download_name=filename)
-    return "文件不存在", 404
+    # 文件已保存在 /tmp；按路径发送，gunicorn 的 wsgi.file_wrapper 会走 sendfile(2) 零拷贝
+    try:
+        return send_from_directory(OUTPUT_DIR, filename, as_attachment=True, download_name=filename, conditional=True)
+    except NotFound:
+        return "文件不存在", 404